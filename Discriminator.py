@@ -7,7 +7,7 @@ def critic_feed_forward(d_model, output):
     return tf.keras.Sequential([
         tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform'),
         tf.keras.layers.LeakyReLU(alpha=0.2),
-        tf.keras.layers.Dense(output, kernel_initializer='glorot_uniform')
+        tf.keras.layers.Dense(output, kernel_initializer='glorot_uniform', dtype='float32')
     ])
 
 
@@ -1,78 +1,232 @@
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras import layers
-import yaml
 
+# Matmuls and convolutions run in bfloat16 with float32 variables; softmax,
+# LayerNorm and the output layers stay in float32.
+tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
 
-def get_angles(pos, i, d_model):
-    angle_rates = 1 / np.power(10000, (2 * (i // 2)) / np.float32(d_model))
-    return pos * angle_rates
+# Shared by AddNorm and the stacked Encoder; both normalise over the last axis through
+# add_layernorm, which XLA compiles into a single add + normalise kernel.
+LAYER_NORM_EPSILON = 1e-6
 
 
 def positional_encoding_1d(position, d_model):
-    angle_rads = get_angles(np.arange(position)[:, np.newaxis], np.arange(d_model)[np.newaxis, :], d_model)
-    angle_rads[:, 0::2] = np.sin(angle_rads[:, 0::2])
-    angle_rads[:, 1::2] = np.cos(angle_rads[:, 1::2])
+    half = d_model // 2
+    inv_freq = np.exp(-np.log(10000.0) * np.arange(half, dtype=np.float32) / half)
+    angle_rads = np.arange(position, dtype=np.float32)[:, np.newaxis] * inv_freq[np.newaxis, :]
 
-    pos_encoding = angle_rads[np.newaxis, ...]
-    return tf.cast(pos_encoding, dtype=tf.float32)
+    # Interleave sin/cos so even channels hold sin and odd channels cos.
+    pos_encoding = np.stack([np.sin(angle_rads), np.cos(angle_rads)], axis=-1).reshape(position, d_model)
+    return tf.constant(pos_encoding[np.newaxis, ...], dtype=tf.float32)
 
 
 def create_padding_mask(seq):
-    seq = tf.cast(tf.math.equal(seq, 0), tf.float32)
-    return seq[:, tf.newaxis, tf.newaxis, :]
+    return tf.cast(seq == 0, tf.float32)[:, tf.newaxis, tf.newaxis, :]
 
 
-def create_look_ahead_mask(size):
-    mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
-    return mask
+@tf.function(jit_compile=True, experimental_relax_shapes=True)
+def add_layernorm(x, y, gamma, beta, epsilon=LAYER_NORM_EPSILON):
+    # Residual add and LayerNorm in one compiled function, so XLA can emit a single
+    # kernel that reads x and y once and never writes out their sum.
+    z = tf.cast(x, tf.float32) + tf.cast(y, tf.float32)
+    mean, variance = tf.nn.moments(z, axes=[-1], keepdims=True)
+    normalized = (z - mean) * tf.math.rsqrt(variance + epsilon)
+    return tf.cast(normalized * gamma + beta, x.dtype)
 
 
-def scaled_dot_product_attention(q, k, v, mask):
-    matmul_qk = tf.matmul(q, k, transpose_b=True)
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
-    scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
+@tf.function(jit_compile=True, experimental_relax_shapes=True)
+def masked_softmax(logits, mask):
+    if mask is None:
+        return tf.nn.softmax(logits, axis=-1)
 
-    if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+    # Masked positions are left out of the row max and zeroed after the exp, so no
+    # large negative bias is added and a fully masked row yields zeros rather than NaN.
+    masked = mask > 0
+    row_max = tf.reduce_max(tf.where(masked, float('-inf'), logits), axis=-1, keepdims=True)
+    row_max = tf.stop_gradient(tf.where(tf.math.is_finite(row_max), row_max, tf.zeros_like(row_max)))
+    exp_logits = tf.where(masked, 0., tf.exp(tf.where(masked, 0., logits - row_max)))
+    return tf.math.divide_no_nan(exp_logits, tf.reduce_sum(exp_logits, axis=-1, keepdims=True))
 
-    attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)
-    output = tf.matmul(attention_weights, v)
+
+@tf.function(jit_compile=True, experimental_relax_shapes=True)
+def scaled_dot_product_attention(q, k, v, mask, scale):
+    matmul_qk = tf.cast(tf.einsum('bqhd,bkhd->bhqk', q, k), tf.float32)
+    scaled_attention_logits = matmul_qk * scale
+
+    attention_weights = masked_softmax(scaled_attention_logits, mask)
+    output = tf.einsum('bhqk,bkhd->bqhd', tf.cast(attention_weights, v.dtype), v)
 
     return output, attention_weights
 
 
+# No shape relaxation: the tiles are laid out from the static key length, and this one
+# function is shared by every caller (64 encoder keys, 1 Critic key, decoder captions),
+# so a relaxed trace would lose that length and fall back to the dense path for all of them.
+@tf.function(jit_compile=True)
+def tiled_attention(q, k, v, mask, scale, block_size=64):
+    # Only tile when the keys span more than one block; a single tile would just be
+    # the dense computation with extra bookkeeping. An unknown length (a caller traced
+    # with relaxed shapes) cannot be split into tiles in Python either.
+    seq_len_k = k.shape[1]
+    if seq_len_k is None or seq_len_k <= block_size:
+        output, _ = scaled_dot_product_attention(q, k, v, mask, scale)
+        return output
+
+    # Online softmax over key/value tiles: keep the running row max and
+    # denominator so the full [..., seq_len_q, seq_len_k] logits are never built.
+    # The first tile seeds the running state directly, so no -inf/zero buffers are needed.
+    # Masking follows masked_softmax: masked keys are left out of the max and zeroed after
+    # the exp, and a row whose keys are all masked so far keeps a -inf max, so it ends as zeros.
+    for start in range(0, seq_len_k, block_size):
+        end = min(start + block_size, seq_len_k)
+        logits = tf.cast(tf.einsum('bqhd,bkhd->bhqk', q, k[:, start:end]), tf.float32) * scale
+        masked = None if mask is None else mask[..., start:end] > 0
+        if masked is not None:
+            logits = tf.where(masked, float('-inf'), logits)
+
+        block_max = tf.stop_gradient(tf.reduce_max(logits, axis=-1, keepdims=True))
+        new_max = block_max if start == 0 else tf.maximum(row_max, block_max)
+        if masked is None:
+            p = tf.exp(logits - new_max)
+        else:
+            safe_max = tf.where(tf.math.is_finite(new_max), new_max, tf.zeros_like(new_max))
+            p = tf.where(masked, 0., tf.exp(tf.where(masked, 0., logits - safe_max)))
+        pv = tf.cast(tf.einsum('bhqk,bkhd->bhqd', tf.cast(p, v.dtype), v[:, start:end]), tf.float32)
+
+        if start == 0:
+            row_sum = tf.reduce_sum(p, axis=-1, keepdims=True)
+            output = pv
+        else:
+            # Zero while the row is still fully masked; its running sum and output are zero then.
+            correction = tf.where(tf.math.is_finite(row_max), tf.exp(row_max - new_max), tf.zeros_like(row_max))
+            row_sum = row_sum * correction + tf.reduce_sum(p, axis=-1, keepdims=True)
+            output = output * correction + pv
+        row_max = new_max
+
+    return tf.cast(tf.einsum('bhqd->bqhd', tf.math.divide_no_nan(output, row_sum)), v.dtype)
+
+
+# Symmetric weight-only quantization of a [..., in, out] kernel: the largest |w| of each
+# group of input rows maps to the top of the signed range, one float scale per output
+# channel and group. int4 weights are packed two per byte: row 2i in the low nibble,
+# row 2i + 1 in the high one.
+def quantize_kernel(kernel, bits, group_size):
+    *lead, input_dim, units = kernel.shape.as_list()
+    q_max = 2 ** (bits - 1) - 1
+    kernel = tf.reshape(kernel, lead + [input_dim // group_size, group_size, units])
+    scale = tf.reduce_max(tf.abs(kernel), axis=-2) / q_max
+    scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+    kernel = tf.clip_by_value(tf.round(kernel / scale[..., tf.newaxis, :]), -q_max - 1, q_max)
+    kernel = tf.reshape(kernel, lead + [input_dim, units])
+
+    if bits == 8:
+        return tf.cast(kernel, tf.int8), scale
+    kernel = tf.cast(kernel, tf.int32) + 8
+    packed = tf.bitwise.bitwise_or(kernel[..., 0::2, :], tf.bitwise.left_shift(kernel[..., 1::2, :], 4))
+    return tf.cast(packed, tf.uint8), scale
+
+
+def dequantize_kernel(kernel, scale, bits, dtype):
+    if bits == 8:
+        kernel = tf.cast(kernel, dtype)
+    else:
+        packed = tf.cast(kernel, tf.int32)
+        kernel = tf.stack([tf.bitwise.bitwise_and(packed, 15), tf.bitwise.right_shift(packed, 4)], axis=-2)
+        kernel = tf.cast(kernel - 8, dtype)
+
+    *lead, num_groups, units = scale.shape.as_list()
+    kernel = tf.reshape(kernel, lead + [num_groups, -1, units]) * tf.cast(scale, dtype)[..., tf.newaxis, :]
+    return tf.reshape(kernel, lead + [-1, units])
+
+
+# Inference-only Dense holding a kernel from quantize_kernel (a single group, i.e.
+# per-channel scales, when group_size is None).
+class QuantizedDense(tf.keras.layers.Layer):
+
+    def __init__(self, units, bits=8, group_size=None, activation=None, **kwargs):
+        super().__init__(**kwargs)
+        assert bits in (4, 8)
+        self.units = units
+        self.bits = bits
+        self.group_size = group_size
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        self.input_dim = int(input_shape[-1])
+        self.group_size = min(self.group_size or self.input_dim, self.input_dim)
+        assert self.input_dim % self.group_size == 0
+
+        if self.bits == 8:
+            self.kernel = self.add_weight('kernel', shape=(self.input_dim, self.units), dtype=tf.int8,
+                                          initializer='zeros', trainable=False)
+        else:
+            assert self.input_dim % 2 == 0
+            self.kernel = self.add_weight('kernel', shape=(self.input_dim // 2, self.units), dtype=tf.uint8,
+                                          initializer='zeros', trainable=False)
+        self.kernel_scale = self.add_weight('kernel_scale', shape=(self.input_dim // self.group_size, self.units),
+                                            initializer='ones', trainable=False)
+        self.bias = self.add_weight('bias', shape=(self.units,), initializer='zeros', trainable=False)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        kernel = dequantize_kernel(self.kernel, self.kernel_scale, self.bits, self.compute_dtype)
+        outputs = tf.nn.bias_add(tf.tensordot(inputs, kernel, axes=1), self.bias)
+        return self.activation(outputs)
+
+    def quantize(self, dense):
+        kernel, scale = quantize_kernel(dense.kernel, self.bits, self.group_size)
+        self.kernel.assign(kernel)
+        self.kernel_scale.assign(scale)
+        self.bias.assign(dense.bias)
+
+
+def dense_layer(units, quantized=False, bits=8, **kwargs):
+    if quantized:
+        return QuantizedDense(units, bits=bits, group_size=128 if bits == 4 else None, **kwargs)
+    return tf.keras.layers.Dense(units, kernel_initializer='glorot_uniform', **kwargs)
+
+
 class MultiHeadedAttention(tf.keras.layers.Layer):
 
-    def __init__(self, d_model, num_heads):
-        super().__init__()
+    def __init__(self, d_model, num_heads, fused_self_attn=False, quantized=False):
+        # No input autocast: casting only the first input would break the identity checks
+        # in call, and the projection layers cast their own inputs anyway.
+        super().__init__(autocast=False)
         self.num_heads = num_heads
         self.d_model = d_model
+        self.fused_self_attn = fused_self_attn
         assert d_model % self.num_heads == 0
 
         self.depth = d_model // self.num_heads
+        self._inv_sqrt_depth = float(1.0 / np.sqrt(self.depth))
 
-        self.wq = tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform')
-        self.wk = tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform')
-        self.wv = tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform')
-        self.dense = tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform')
+        if fused_self_attn:
+            self.wqkv = dense_layer(3 * d_model, quantized)
+        else:
+            self.wq = dense_layer(d_model, quantized)
+            self.wkv = dense_layer(2 * d_model, quantized)
+        self.dense = dense_layer(d_model, quantized)
 
-    def split_heads(self, x, batch_size):
-        x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
-        return tf.transpose(x, perm=[0, 2, 1, 3])
-
-    def call(self, v, k, q, mask=None):
+    def call(self, v, k, q, mask=None, return_attention_weights=True):
         batch_size = tf.shape(q)[0]
-        q = self.wq(q)
-        k = self.wk(k)
-        v = self.wv(v)
-
-        q = self.split_heads(q, batch_size)
-        k = self.split_heads(k, batch_size)
-        v = self.split_heads(v, batch_size)
-
-        scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
-        scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])
+        # Keys and values share one projection input, and fused self-attention also
+        # projects the queries from it, so the inputs must actually be the same tensor.
+        assert k is v
+        if self.fused_self_attn:
+            assert q is k
+            q, k, v = tf.split(self.wqkv(q), 3, axis=-1)
+        else:
+            q = self.wq(q)
+            k, v = tf.split(self.wkv(k), 2, axis=-1)
+
+        q = tf.reshape(q, (batch_size, -1, self.num_heads, self.depth))
+        k = tf.reshape(k, (batch_size, -1, self.num_heads, self.depth))
+        v = tf.reshape(v, (batch_size, -1, self.num_heads, self.depth))
+
+        if return_attention_weights:
+            scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask, self._inv_sqrt_depth)
+        else:
+            scaled_attention, attention_weights = tiled_attention(q, k, v, mask, self._inv_sqrt_depth), None
 
         concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.d_model))
 
@@ -80,126 +234,230 @@ class MultiHeadedAttention(tf.keras.layers.Layer):
         return output, attention_weights
 
 
-def point_wise_feed_forward_network(d_model, dff):
-    return tf.keras.Sequential([
-        tf.keras.layers.Dense(dff, activation='relu', kernel_initializer='glorot_uniform'),
-        tf.keras.layers.Dense(d_model, kernel_initializer='glorot_uniform')
-    ])
-
+class PointWiseFeedForward(tf.keras.layers.Layer):
 
-class EncoderLayer(tf.keras.layers.Layer):
-
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, dff, quantized=False):
         super().__init__()
-        self.mha = MultiHeadedAttention(d_model, num_heads)
-        self.ffn = point_wise_feed_forward_network(d_model, dff)
-
-        self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.dense1 = dense_layer(dff, quantized, bits=4, activation='relu')
+        self.dense2 = dense_layer(d_model, quantized, bits=4)
 
-        self.dropout1 = tf.keras.layers.Dropout(rate)
-        self.dropout2 = tf.keras.layers.Dropout(rate)
+    # Compiled as one unit so the bias add and ReLU run as the first matmul's epilogue.
+    @tf.function(jit_compile=True, experimental_relax_shapes=True)
+    def call(self, x):
+        return self.dense2(self.dense1(x))
 
-    def call(self, x, training, mask=None):
-        attn_output, _ = self.mha(x, x, x, mask)
-        attn_output = self.dropout1(attn_output, training=training)
 
-        out1 = self.layernorm1(x + attn_output)
+# LayerNormalization applied to a residual sum: call(x, y) returns LayerNorm(x + y) through
+# add_layernorm, with this layer's own gamma, beta and epsilon.
+class AddNorm(tf.keras.layers.LayerNormalization):
 
-        ffn_output = self.ffn(out1)
-        ffn_output = self.dropout2(ffn_output, training=training)
-        out2 = self.layernorm2(out1 + ffn_output)
+    def build(self, input_shape):
+        super().build(input_shape)
+        # add_layernorm only normalises over the last axis.
+        assert self.axis == [len(input_shape) - 1]
 
-        return out2
+    def call(self, x, y):
+        return add_layernorm(x, y, self.gamma, self.beta, self.epsilon)
 
 
 class DecoderLayer(tf.keras.layers.Layer):
 
-    def __init__(self, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, d_model, num_heads, dff, rate=0.1, quantized=False):
         super().__init__()
-        self.mha1 = MultiHeadedAttention(d_model, num_heads)
-        self.mha2 = MultiHeadedAttention(d_model, num_heads)
+        self.mha1 = MultiHeadedAttention(d_model, num_heads, fused_self_attn=True, quantized=quantized)
+        self.mha2 = MultiHeadedAttention(d_model, num_heads, quantized=quantized)
 
-        self.ffn = point_wise_feed_forward_network(d_model, dff)
+        self.ffn = PointWiseFeedForward(d_model, dff, quantized)
 
-        self.layernorm1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.layernorm2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.layernorm3 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.layernorm1 = AddNorm(axis=-1, epsilon=LAYER_NORM_EPSILON)
+        self.layernorm2 = AddNorm(axis=-1, epsilon=LAYER_NORM_EPSILON)
+        self.layernorm3 = AddNorm(axis=-1, epsilon=LAYER_NORM_EPSILON)
 
         self.dropout1 = tf.keras.layers.Dropout(rate)
         self.dropout2 = tf.keras.layers.Dropout(rate)
         self.dropout3 = tf.keras.layers.Dropout(rate)
 
     def call(self, x, enc_output, training, look_ahead_mask=None, padding_mask=None):
-        attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask)
-        attn1 = self.dropout1(attn1, training=training)
-        out1 = self.layernorm1(attn1 + x)
-
-        attn2, attn_weights_block2 = self.mha2(enc_output, enc_output, out1, padding_mask)
-        attn2 = self.dropout2(attn2, training=training)
-        out2 = self.layernorm2(attn2 + out1)
+        # Attention weights are only kept for inference; training uses the tiled path.
+        attn1, attn_weights_block1 = self.mha1(x, x, x, look_ahead_mask, return_attention_weights=not training)
+        if training:
+            attn1 = self.dropout1(attn1, training=True)
+        out1 = self.layernorm1(attn1, x)
+
+        attn2, attn_weights_block2 = self.mha2(enc_output, enc_output, out1, padding_mask,
+                                               return_attention_weights=not training)
+        if training:
+            attn2 = self.dropout2(attn2, training=True)
+        out2 = self.layernorm2(attn2, out1)
 
         ffn_output = self.ffn(out2)
-        ffn_output = self.dropout3(ffn_output, training=training)
-        out3 = self.layernorm3(ffn_output + out2)
+        if training:
+            ffn_output = self.dropout3(ffn_output, training=True)
+        out3 = self.layernorm3(ffn_output, out2)
 
         return out3, attn_weights_block1, attn_weights_block2
 
 
+def stacked_glorot_uniform(shape, dtype=None):
+    # Glorot-initialise each [in, out] slice on its own so the leading layer axis
+    # does not count towards the fan-in/fan-out.
+    # A fresh initializer per slice: an unseeded initializer reused across calls may
+    # return the same values every time.
+    return tf.stack([tf.keras.initializers.GlorotUniform()(shape[1:], dtype=dtype) for _ in range(shape[0])])
+
+
+# The encoder keeps each weight kind of all its layers in one [num_layers, ...] variable,
+# which keeps the weights and optimizer slots contiguous; the layer loop is unrolled when
+# traced. With quantized=True the attention kernels are int8 and the feed-forward ones
+# int4, as in QuantizedDense, and the weights are filled in by quantize().
 class Encoder(tf.keras.layers.Layer):
+    _kernel_bits = {'wqkv': 8, 'wo': 8, 'w1': 4, 'w2': 4}
 
-    def __init__(self, num_layers, d_model, num_heads, dff, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, rate=0.1, quantized=False):
         super().__init__()
+        assert d_model % num_heads == 0
         self.d_model = d_model
         self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.depth = d_model // num_heads
+        self._inv_sqrt_depth = float(1.0 / np.sqrt(self.depth))
+        self.dff = dff
+        self.quantized = quantized
 
         self.embedding = tf.keras.layers.Dense(self.d_model,
                                                activation='relu',
                                                kernel_initializer='glorot_uniform')
         # self.pos_encoding = positional_encoding_2d(8, 8, self.d_model)
-
-        self.enc_layers = [EncoderLayer(d_model, num_heads, dff, rate) for _ in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate)
 
+    def _add_kernel(self, name, input_dim, units):
+        shape = (self.num_layers, input_dim, units)
+        if not self.quantized:
+            return self.add_weight(name, shape=shape, initializer=stacked_glorot_uniform), None
+
+        bits = self._kernel_bits[name]
+        group_size = min(128, input_dim) if bits == 4 else input_dim
+        if bits == 8:
+            kernel = self.add_weight(name, shape=shape, dtype=tf.int8, initializer='zeros', trainable=False)
+        else:
+            kernel = self.add_weight(name, shape=(self.num_layers, input_dim // 2, units), dtype=tf.uint8,
+                                     initializer='zeros', trainable=False)
+        scale = self.add_weight(name + '_scale', shape=(self.num_layers, input_dim // group_size, units),
+                                initializer='ones', trainable=False)
+        return kernel, scale
+
+    def build(self, input_shape):
+        num_layers, d_model, dff = self.num_layers, self.d_model, self.dff
+
+        self.wqkv, self.wqkv_scale = self._add_kernel('wqkv', d_model, 3 * d_model)
+        self.bqkv = self.add_weight('bqkv', shape=(num_layers, 3 * d_model), initializer='zeros')
+        self.wo, self.wo_scale = self._add_kernel('wo', d_model, d_model)
+        self.bo = self.add_weight('bo', shape=(num_layers, d_model), initializer='zeros')
+        self.w1, self.w1_scale = self._add_kernel('w1', d_model, dff)
+        self.b1 = self.add_weight('b1', shape=(num_layers, dff), initializer='zeros')
+        self.w2, self.w2_scale = self._add_kernel('w2', dff, d_model)
+        self.b2 = self.add_weight('b2', shape=(num_layers, d_model), initializer='zeros')
+
+        # LayerNorm parameters stay float32 inside call, like Keras LayerNormalization's.
+        self.ln1_gamma = self.add_weight('ln1_gamma', shape=(num_layers, d_model), initializer='ones',
+                                         experimental_autocast=False)
+        self.ln1_beta = self.add_weight('ln1_beta', shape=(num_layers, d_model), initializer='zeros',
+                                        experimental_autocast=False)
+        self.ln2_gamma = self.add_weight('ln2_gamma', shape=(num_layers, d_model), initializer='ones',
+                                         experimental_autocast=False)
+        self.ln2_beta = self.add_weight('ln2_beta', shape=(num_layers, d_model), initializer='zeros',
+                                        experimental_autocast=False)
+        super().build(input_shape)
+
+    def _layer_kernel(self, name, i):
+        kernel = getattr(self, name)[i]
+        if not self.quantized:
+            return kernel
+        return dequantize_kernel(kernel, getattr(self, name + '_scale')[i], self._kernel_bits[name],
+                                 self.compute_dtype)
+
+    @tf.function(jit_compile=True, experimental_relax_shapes=True)
     def call(self, x, training, mask=None):
-        seq_len = tf.shape(x)[1]
+        batch_size = tf.shape(x)[0]
         x = self.embedding(x)
         # x += self.pos_encoding[:, :seq_len, :]
-        x = self.dropout(x, training=training)
+        if training:
+            x = self.dropout(x, training=True)
 
         for i in range(self.num_layers):
-            x = self.enc_layers[i](x, training, mask)
+            qkv = tf.einsum('bld,de->ble', x, self._layer_kernel('wqkv', i)) + self.bqkv[i]
+            q, k, v = tf.split(qkv, 3, axis=-1)
+            q = tf.reshape(q, (batch_size, -1, self.num_heads, self.depth))
+            k = tf.reshape(k, (batch_size, -1, self.num_heads, self.depth))
+            v = tf.reshape(v, (batch_size, -1, self.num_heads, self.depth))
+
+            attn_output = tiled_attention(q, k, v, mask, self._inv_sqrt_depth)
+            attn_output = tf.reshape(attn_output, (batch_size, -1, self.d_model))
+            attn_output = tf.einsum('bld,de->ble', attn_output, self._layer_kernel('wo', i)) + self.bo[i]
+            if training:
+                attn_output = self.dropout(attn_output, training=True)
+            out1 = add_layernorm(x, attn_output, self.ln1_gamma[i], self.ln1_beta[i])
+
+            ffn_output = tf.nn.relu(tf.einsum('bld,df->blf', out1, self._layer_kernel('w1', i)) + self.b1[i])
+            ffn_output = tf.einsum('blf,fd->bld', ffn_output, self._layer_kernel('w2', i)) + self.b2[i]
+            if training:
+                ffn_output = self.dropout(ffn_output, training=True)
+            x = add_layernorm(out1, ffn_output, self.ln2_gamma[i], self.ln2_beta[i])
 
         return x
 
+    def quantize(self, encoder):
+        self.embedding.set_weights(encoder.embedding.get_weights())
+        for name, bits in self._kernel_bits.items():
+            scale = getattr(self, name + '_scale')
+            group_size = getattr(encoder, name).shape[1] // scale.shape[1]
+            kernel, kernel_scale = quantize_kernel(getattr(encoder, name), bits, group_size)
+            getattr(self, name).assign(kernel)
+            scale.assign(kernel_scale)
+        for name in ('bqkv', 'bo', 'b1', 'b2', 'ln1_gamma', 'ln1_beta', 'ln2_gamma', 'ln2_beta'):
+            getattr(self, name).assign(getattr(encoder, name))
+
 
 class Decoder(tf.keras.layers.Layer):
 
-    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1):
+    def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, maximum_position_encoding, rate=0.1,
+                 quantized=False):
         super().__init__()
 
         self.d_model = d_model
         self.num_layers = num_layers
 
         self.embedding = tf.keras.layers.Embedding(target_vocab_size, d_model)
+        self._embed_scale = float(np.sqrt(d_model))
         self.pos_embedding = positional_encoding_1d(maximum_position_encoding, d_model)
+        self._causal_mask = tf.constant(np.triu(np.ones((maximum_position_encoding, maximum_position_encoding),
+                                                        dtype=bool), k=1))
 
-        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate) for _ in range(num_layers)]
+        self.dec_layers = [DecoderLayer(d_model, num_heads, dff, rate, quantized) for _ in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate)
 
+    @tf.function(jit_compile=True, experimental_relax_shapes=True)
     def call(self, x, enc_output, training, look_ahead_mask=None, padding_mask=None):
         seq_len = tf.shape(x)[1]
         attention_weights = {}
 
+        causal_mask = tf.cast(self._causal_mask[:seq_len, :seq_len], tf.float32)
+        if look_ahead_mask is None:
+            look_ahead_mask = causal_mask
+        else:
+            look_ahead_mask = tf.maximum(look_ahead_mask, causal_mask)
+
         x = self.embedding(x)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_embedding[:, :seq_len, :]
-        x = self.dropout(x, training=training)
+        x *= self._embed_scale
+        x += tf.cast(self.pos_embedding[:, :seq_len, :], x.dtype)
+        if training:
+            x = self.dropout(x, training=True)
 
         for i in range(self.num_layers):
             x, block1, block2 = self.dec_layers[i](x, enc_output, training, look_ahead_mask, padding_mask)
-            attention_weights[f'decoder_layer{i + 1}_block1'] = block1
-            attention_weights[f'decoder_layer{i + 2}_block2'] = block2
+            if not training:
+                attention_weights[f'decoder_layer{i + 1}_block1'] = block1
+                attention_weights[f'decoder_layer{i + 1}_block2'] = block2
 
         return x, attention_weights
 
@@ -207,19 +465,49 @@ class Decoder(tf.keras.layers.Layer):
 class Transformer(tf.keras.Model):
 
     def __init__(self, num_layers, d_model, num_heads, dff, target_vocab_size, max_pos_encoding,
-                 rate=0.1):
+                 rate=0.1, quantized=False):
         super().__init__()
-        self.encoder = Encoder(num_layers, d_model, num_heads, dff, rate)
-        self.decoder = Decoder(num_layers, d_model, num_heads, dff, target_vocab_size, max_pos_encoding, rate)
-        self.final_layer = tf.keras.layers.Dense(target_vocab_size, kernel_initializer='glorot_uniform')
-
+        self.encoder = Encoder(num_layers, d_model, num_heads, dff, rate, quantized)
+        self.decoder = Decoder(num_layers, d_model, num_heads, dff, target_vocab_size, max_pos_encoding, rate,
+                               quantized)
+        # The output projection is tied to the decoder embedding; only the bias is its own.
+        self.final_bias = self.add_weight('final_bias', shape=(target_vocab_size,), initializer='zeros',
+                                          experimental_autocast=False)
+
+    @tf.function(jit_compile=True, experimental_relax_shapes=True)
     def call(self, inp, tar, training, look_ahead_mask=None, dec_padding_mask=None, enc_padding_mask=None):
         enc_output = self.encoder(inp, training, enc_padding_mask)
         dec_output, attention_weights = self.decoder(tar, enc_output, training, look_ahead_mask, dec_padding_mask)
-        final_output = self.final_layer(dec_output)
+        final_output = tf.matmul(tf.cast(dec_output, tf.float32), self.decoder.embedding.embeddings, transpose_b=True)
+        final_output += self.final_bias
         return final_output, attention_weights
 
 
+# Copies a trained Transformer into one with the same configuration built with
+# quantized=True; inp/tar are a sample batch used to build the quantized weights.
+def quantize_transformer(transformer, quantized_transformer, inp, tar):
+    quantized_transformer(inp, tar, False)
+
+    layers, quantized_layers = transformer.submodules, quantized_transformer.submodules
+    if len(layers) != len(quantized_layers):
+        raise ValueError(f'Transformer has {len(layers)} submodules but the quantized one has '
+                         f'{len(quantized_layers)}; the two must share a configuration.')
+    for layer, quantized_layer in zip(layers, quantized_layers):
+        expected = tf.keras.layers.Dense if isinstance(quantized_layer, QuantizedDense) else type(quantized_layer)
+        if type(layer) is not expected:
+            raise ValueError(f'Cannot copy {type(layer).__name__} {layer.name!r} into '
+                             f'{type(quantized_layer).__name__} {quantized_layer.name!r}.')
+
+    for layer, quantized_layer in zip(layers, quantized_layers):
+        if isinstance(quantized_layer, (QuantizedDense, Encoder)):
+            quantized_layer.quantize(layer)
+        elif isinstance(quantized_layer, (tf.keras.layers.Dense, tf.keras.layers.LayerNormalization,
+                                          tf.keras.layers.Embedding)):
+            quantized_layer.set_weights(layer.get_weights())
+    quantized_transformer.final_bias.assign(transformer.final_bias)
+    return quantized_transformer
+
+
 NUM_LAYERS = 4
 D_MODEL = 512
 DFF = 2048
@@ -231,6 +519,7 @@ TARGET_VOCAB_SIZE = 5000 + 1
 DROPOUT_RATE = 0.1
 ROW_SIZE = 8
 COL_SIZE = 8
+FEATURE_SIZE = 2048
 
 
 # class TextToImage(tf.keras.layers.Layer):
@@ -245,6 +534,8 @@ COL_SIZE = 8
 #         self.conv1 =
 
 def resnet_block(model, kernel_size, filters, strides):
+    from tensorflow.keras import layers
+
     gen = model
     model = layers.Conv2D(filters=filters, kernel_size=kernel_size, strides=strides, padding="same")(model)
     model = layers.BatchNormalization(momentum=0.5)(model)
@@ -256,7 +547,23 @@ def resnet_block(model, kernel_size, filters, strides):
     return model
 
 
+def upsample(model, filters, kernel_init):
+    from tensorflow.keras import layers
+
+    # Sub-pixel upsampling: a stride-1 conv to 4x the channels, then rearrange them into a 2x larger map.
+    # A 2x2 kernel keeps the parameter count close to the 3x3 stride-2 transposed conv it replaces.
+    conv = layers.Conv2D(filters=filters * 4, kernel_size=(2, 2), padding="same", kernel_initializer=kernel_init)
+    model = conv(model)
+    # ICNR: all four sub-pixel positions start from the same kernel, so the layer begins as a
+    # nearest-neighbour upsample of one conv and does not introduce checkerboard artefacts.
+    # Done after building so the layer config keeps a serialisable initializer.
+    conv.kernel.assign(tf.tile(conv.kernel[..., :filters], [1, 1, 1, 4]))
+    return tf.nn.depth_to_space(model, 2)
+
+
 def TextToImage():
+    from tensorflow.keras import layers
+
     kernel_init = tf.random_normal_initializer(stddev=0.02)
     batch_init = tf.random_normal_initializer(1., 0.02)
 
@@ -284,23 +591,20 @@ def TextToImage():
     model = layers.BatchNormalization(momentum=0.5)(model)
     model = layers.Add()([gen_model, model])
 
-    model = layers.Conv2DTranspose(filters=512, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 512, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=256, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 256, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=128, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 128, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=64, kernel_size=(3, 3), strides=(1, 1), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = layers.Conv2D(filters=64, kernel_size=(3, 3), strides=(1, 1), padding="same",
+                          kernel_initializer=kernel_init)(model)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2D(3, (3, 3), padding='same', activation='tanh')(model)
+    model = layers.Conv2D(3, (3, 3), padding='same', activation='tanh', dtype='float32')(model)
 
     # generator_model = Model(inputs=[random_input, text_input1], outputs=model)
 
@@ -316,6 +620,16 @@ class Network(tf.keras.Model):
                                          max_pos_encoding=TARGET_VOCAB_SIZE, rate=DROPOUT_RATE)
         self.text_to_image = TextToImage()
 
+        # Trace inference once for the fixed batch and image-feature shapes so XLA can
+        # specialise its kernels; only the caption length stays dynamic.
+        self._infer = tf.function(lambda inp, tar: self.image_to_text(inp, tar, False)[0],
+                                  jit_compile=True).get_concrete_function(
+            tf.TensorSpec([BATCH_SIZE, ROW_SIZE * COL_SIZE, FEATURE_SIZE], tf.float32),
+            tf.TensorSpec([BATCH_SIZE, None], tf.int32))
+
+    def infer(self, inp, tar):
+        return self._infer(inp, tar)
+
     def call(self, inp, tar, training, look_ahead_mask=None, dec_padding_mask=None, enc_padding_mask=None):
         p, w = self.image_to_text(inp, tar, False, dec_padding_mask)
         print('this is final warning')
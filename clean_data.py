@@ -19,6 +19,8 @@ count = 1
 num_layer = 4
 BATCH_SIZE = 64
 BUFFER_SIZE = 1000
+FEATURE_SHAPE = (8 * 8, 2048)
+IMAGE_SHAPE = (64, 64, 3)
 top_k = 5000
 # target_vocab_size = top_k + 1
 target_vocab_size = 5000 + 1
@@ -179,9 +181,16 @@ def map_func(img_name, cap):
     return img_tensor, cap, img_name, image
 
 
+def load_example(img_name, cap):
+    img_tensor, cap, img_name, image = tf.numpy_function(map_func, [img_name, cap],
+                                                         [tf.float32, tf.int32, tf.string, tf.float32])
+    # numpy_function drops static shapes; restore them so batches have a fully known shape.
+    # The features may be saved as the 8x8x2048 InceptionV3 map or already flattened to 64x2048.
+    return (tf.reshape(img_tensor, FEATURE_SHAPE), tf.ensure_shape(cap, cap_vector.shape[1:]),
+            tf.ensure_shape(img_name, ()), tf.ensure_shape(image, IMAGE_SHAPE))
+
+
 dataset = tf.data.Dataset.from_tensor_slices((img_name_train, cap_train))
-dataset = dataset.map(
-    lambda item1, item2: tf.numpy_function(map_func, [item1, item2], [tf.float32, tf.int32, tf.string, tf.float32]),
-    num_parallel_calls=tf.data.experimental.AUTOTUNE)
-dataset = dataset.shuffle(BUFFER_SIZE).batch(BATCH_SIZE)
+dataset = dataset.map(load_example, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+dataset = dataset.shuffle(BUFFER_SIZE).batch(BATCH_SIZE, drop_remainder=True)
 dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
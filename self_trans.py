@@ -6,7 +6,7 @@ warnings.filterwarnings("ignore")
 from clean_data import *
 from text2image_gan_ms import *
 from Discriminator import Critic
-from Generator import create_look_ahead_mask, create_padding_mask, Transformer
+from Generator import create_padding_mask, Transformer
 
 NUM_LAYERS = 4
 D_MODEL = 512
@@ -36,10 +36,9 @@ class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
 
 
 def create_masks_decoder(tar):
-    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    # The decoder combines this with its cached causal mask.
     dec_target_padding_mask = create_padding_mask(tar)
-    combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
-    return combined_mask
+    return dec_target_padding_mask
 
 
 def i2T_dis_loss(f_cap, r_cap):
@@ -103,7 +103,7 @@ def define_discriminator():
 
     discriminator = layers.LeakyReLU(0.2)(discriminator)
 
-    discriminator = layers.Dense(1)(discriminator)
+    discriminator = layers.Dense(1, dtype='float32')(discriminator)
 
     discriminator_model = Model(
         inputs=[dis_input, in_label], outputs=discriminator)
@@ -127,6 +127,18 @@ def resnet_block(model, kernel_size, filters, strides):
     return model
 
 
+def upsample(model, filters, kernel_init):
+    # Sub-pixel upsampling: a stride-1 conv to 4x the channels, then rearrange them into a 2x larger map.
+    # A 2x2 kernel keeps the parameter count close to the 3x3 stride-2 transposed conv it replaces.
+    conv = layers.Conv2D(filters=filters * 4, kernel_size=(2, 2), padding="same", kernel_initializer=kernel_init)
+    model = conv(model)
+    # ICNR: all four sub-pixel positions start from the same kernel, so the layer begins as a
+    # nearest-neighbour upsample of one conv and does not introduce checkerboard artefacts.
+    # Done after building so the layer config keeps a serialisable initializer.
+    conv.kernel.assign(tf.tile(conv.kernel[..., :filters], [1, 1, 1, 4]))
+    return tf.nn.depth_to_space(model, 2)
+
+
 # Generator model
 def define_generator():
     kernel_init = tf.random_normal_initializer(stddev=0.02)
@@ -158,23 +170,20 @@ def define_generator():
     model = layers.BatchNormalization(momentum=0.5)(model)
     model = layers.Add()([gen_model, model])
 
-    model = layers.Conv2DTranspose(filters=512, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 512, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=256, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 256, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=128, kernel_size=(3, 3), strides=(2, 2), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = upsample(model, 128, kernel_init)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2DTranspose(filters=64, kernel_size=(3, 3), strides=(1, 1), padding="same",
-                                   kernel_initializer=kernel_init)(model)
+    model = layers.Conv2D(filters=64, kernel_size=(3, 3), strides=(1, 1), padding="same",
+                          kernel_initializer=kernel_init)(model)
     model = layers.LeakyReLU(0.2)(model)
 
-    model = layers.Conv2D(3, (3, 3), padding='same', activation='tanh')(model)
+    model = layers.Conv2D(3, (3, 3), padding='same', activation='tanh', dtype='float32')(model)
 
     generator_model = Model(inputs=[random_input, text_input1], outputs=model)
 
@@ -183,6 +192,48 @@ def define_generator():
     return generator_model
 
 
+# Inference-only copy of a functional model with each Conv2D -> BatchNormalization pair
+# merged: the moving statistics go into the conv's kernel and bias, the BN becomes an identity.
+def fold_batch_norm(model):
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, layers.BatchNormalization):
+            continue
+        conv = layer.inbound_nodes[0].inbound_layers
+        # Only a linear conv whose channels are the axis BN normalises can absorb it.
+        if (isinstance(conv, layers.Conv2D) and len(conv.outbound_nodes) == 1
+                and conv.activation is tf.keras.activations.linear
+                and conv.data_format == 'channels_last' and layer.axis == [len(layer.input_shape) - 1]):
+            folds[conv.name] = layer
+    folded_bns = {bn.name for bn in folds.values()}
+
+    def clone_layer(layer):
+        if layer.name in folded_bns:
+            return layers.Activation('linear', name=layer.name)
+        config = layer.get_config()
+        if layer.name in folds:
+            config['use_bias'] = True
+        return layer.__class__.from_config(config)
+
+    folded_model = tf.keras.models.clone_model(model, clone_function=clone_layer)
+
+    for layer in model.layers:
+        if layer.name in folds:
+            bn = folds[layer.name]
+            moving_mean, moving_variance = bn.moving_mean.numpy(), bn.moving_variance.numpy()
+            # BN built with scale=False or center=False has no gamma or beta.
+            gamma = bn.gamma.numpy() if bn.scale else np.ones_like(moving_mean)
+            beta = bn.beta.numpy() if bn.center else np.zeros_like(moving_mean)
+            scale = gamma / np.sqrt(moving_variance + bn.epsilon)
+            kernel = layer.get_weights()[0]
+            bias = layer.get_weights()[1] if layer.use_bias else np.zeros_like(moving_mean)
+            folded_model.get_layer(layer.name).set_weights([kernel * scale, (bias - moving_mean) * scale + beta])
+        elif layer.name not in folded_bns and layer.weights:
+            folded_model.get_layer(layer.name).set_weights(layer.get_weights())
+
+    return folded_model
+
+
 def generate_latent_points(latent_dim, n_samples, captions):
     x_input = tf.random.normal([n_samples, latent_dim])
     text_captions = get_random_word_vectors_from_dataset(n_samples, captions)